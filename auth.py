@@ -1,12 +1,21 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import hmac
 import logging
+import os
+import secrets
+import time
+from cachetools import TTLCache
 from fastapi.security import OAuth2PasswordBearer   
-from passlib.context import CryptContext
 from pydantic import ValidationError  
-from config import ALGORITHM, SECRET_KEY
+from config import ALGORITHM, LOG_LEVEL, REFRESH_TOKEN_EXPIRE_MINUTES, SECRET_KEY
 from models import User  
-from jose import JWTError, jwt  
-from datetime import datetime, timedelta, timezone
-from typing import Annotated, Union  
+import jwt
+from jwt import InvalidTokenError as JWTError
+from datetime import timedelta
+from typing import Annotated, Optional, Union  
 from fastapi import Depends, HTTPException, status
 
 from mongo_driver import get_user_by_name_from_MongoDB
@@ -20,12 +29,45 @@ Responsible for Role base access control with JWT
 # Global variables
 # Initialize logger (use the logger instead of print for debugging)
 logger = logging.getLogger('uvicorn.error')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")  
 
-refresh_tokens = set()
+# bcrypt verification is CPU bound on purpose, run it on its own bounded pool instead of the event loop
+_password_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+def _credentials_exception() -> HTTPException:
+    """
+    Build the 401 raised by the auth dependencies (only on the failure paths, a fresh one per raise so concurrent requests never share it)
+    """
+    return HTTPException(  
+        status_code=status.HTTP_401_UNAUTHORIZED,  
+        detail="Could not validate credentials",  
+        headers={"WWW-Authenticate": "Bearer"},  
+    )  
+
+DEFAULT_TOKEN_EXPIRES = timedelta(minutes=15)
+
+ACCESS_TOKEN_KIND = b"A"
+REFRESH_TOKEN_KIND = b"R"
+
+# Issued refresh tokens keyed by hash_token(token, REFRESH_TOKEN_KIND), entries expire together with the token itself
+refresh_tokens = TTLCache(maxsize=100_000, ttl=REFRESH_TOKEN_EXPIRE_MINUTES * 60)
+
+# Decoded JWT payloads keyed by a blake2b digest of the raw token, so repeated requests with the same bearer token skip signature verification
+_token_payload_cache = TTLCache(maxsize=4096, ttl=5)
+
+# Fields of signed in users keyed by username, so the auth dependencies don't query MongoDB on every request
+_user_cache = TTLCache(maxsize=1024, ttl=30)
+
+@functools.cache
+def _pwd_ctx():
+    """
+    Build the bcrypt CryptContext the first time a hashed password is checked, so importing this module stays cheap
+    """
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 async def authenticate_user(username: str, password: str) -> Union[User, bool]:   
     """
@@ -35,21 +77,84 @@ async def authenticate_user(username: str, password: str) -> Union[User, bool]:
     if not user:  
         return False  
     
-    logger.debug(f"Checking password for user: {username}")
+    logger.debug("Checking password for user: %s", username)
 
-    if user.password != password:
-        logger.error(f"Password mismatch")
+    password_matches = None
+    if user.password.startswith(BCRYPT_PREFIXES):
+        loop = asyncio.get_running_loop()
+        try:
+            password_matches = await loop.run_in_executor(_password_executor, _pwd_ctx().verify, password, user.password)
+        except ValueError:
+            # looks like bcrypt but isn't a valid hash, so it's a plain-text password that happens to start the same way
+            password_matches = None
+    if password_matches is None:
+        # plain-text passwords (see the sample users), compared in constant time
+        password_matches = hmac.compare_digest(user.password.encode(), password.encode())
+
+    if not password_matches:
+        logger.error("Password mismatch")
         return False
-    logger.debug(f"Password matches")
+    logger.debug("Password matches")
     return user  
 
-def create_token(data: dict, expires_delta: timedelta = timedelta(minutes=15)):
+def hash_token(token: str, kind: bytes) -> bytes:
+    """
+    Short fixed size digest of a JWT, used as a key instead of the full token string (prefixed by kind so access and refresh keys never collide)
+    """
+    return kind + hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def _cached_decode(token: str, kind: bytes) -> dict:
+    """
+    Decode a JWT, reusing the payload if the same token was verified in the last few seconds
+    """
+    key = hash_token(token, kind)
+    cached = _token_payload_cache.get(key)
+    if cached is not None:
+        payload, expires_at = cached
+        # never serve a token from cache once it has expired
+        if expires_at > time.time():
+            return payload
+        _token_payload_cache.pop(key, None)
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if "exp" in payload:
+        _token_payload_cache[key] = (payload, payload["exp"])
+    return payload
+
+async def _get_user_cached(username: str) -> Union[User, None]:
+    """
+    Fetch a user by username, reusing the User fetched by a recent request if there is one
+    """
+    cached_user = _user_cache.get(username)
+    if cached_user is not None:
+        # the cached fields were validated when the user was fetched, so skip validating them again
+        # (copy the usage dict so a caller mutating it can't change the cached entry)
+        usage = cached_user["current_api_usage"]
+        return User.model_construct(**{**cached_user, "current_api_usage": dict(usage) if usage is not None else None})
+
+    user = await get_user_by_name_from_MongoDB(username)
+    if user is not None:
+        _user_cache[username] = user.model_dump(by_alias=True)
+    return user
+
+def invalidate_user(username: Optional[str] = None):
+    """
+    Drop a user from the auth cache after their document changes in MongoDB (drops every user if no username is given)
+    """
+    if username is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(username, None)
+
+def create_token(data: dict, expires_delta: timedelta = DEFAULT_TOKEN_EXPIRES):
     """
     Helper method used for creating the accessa and refresh token
     """
     to_encode = data.copy()  
-    expire = datetime.now(timezone.utc) + expires_delta  
-    to_encode.update({"exp": expire})  
+    # exp is written as an epoch timestamp directly so the JWT library doesn't have to convert a datetime
+    to_encode["exp"] = int(time.time() + expires_delta.total_seconds())  
+    # exp only has whole-second resolution, so a random jti keeps tokens issued in the same second distinct
+    to_encode["jti"] = secrets.token_urlsafe(16)
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)  
     return encoded_jwt
 
@@ -57,62 +162,68 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     """
     Get the current user that is signed in via FastAPI's OAuth2PasswordBearer
     """
-    credentials_exception = HTTPException(  
-        status_code=status.HTTP_401_UNAUTHORIZED,  
-        detail="Could not validate credentials",  
-        headers={"WWW-Authenticate": "Bearer"},  
-    )  
     try:  
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])  
+        payload = _cached_decode(token, ACCESS_TOKEN_KIND)  
         username: str = payload.get("sub")  
         if username is None:  
-            raise credentials_exception  
+            raise _credentials_exception()  
     except JWTError:  
-        raise credentials_exception  
-    user = await get_user_by_name_from_MongoDB(username)  
+        raise _credentials_exception()  
+    user = await _get_user_cached(username)  
     if user is None:  
-        raise credentials_exception  
+        raise _credentials_exception()  
     return user  
 
 class CheckedRoleIs:  
     """
-    Checks if a user is part of the allowed roles, return True if this is case, False otherwise
+    Checks if a user is part of the allowed roles, return the user if this is case, raise an exception otherwise
 
     Responsible for protecting an endpoint.
     """
     def __init__(self, allowed_roles):  
-        self.allowed_roles = allowed_roles  
+        self.allowed_roles = frozenset(allowed_roles)  
+        self.forbidden_detail = f"You don't have enough permissions (not one of {sorted(self.allowed_roles)})"  
 
-    def __call__(self, user: Annotated[User, Depends(get_current_user)]):  
+    async def __call__(self, user: Annotated[User, Depends(get_current_user)]) -> User:  
         """
         Allows this class to be called like a method, so Depends will work for this class and we can create a protected endpoint
         """
         if user.role in self.allowed_roles:  
-            return True  
+            # the user (always truthy) lets endpoints use the checked user directly instead of depending on get_current_user again
+            return user  
         raise HTTPException(  
             status_code=status.HTTP_401_UNAUTHORIZED,   
-            detail=f"You don't have enough permissions (not one of {self.allowed_roles})")  
+            detail=self.forbidden_detail)  
+
+# Shared role checks, reusing the same instance lets FastAPI cache the result once per request
+require_admin = CheckedRoleIs(allowed_roles=["admin"])
+require_user = CheckedRoleIs(allowed_roles=["user"])
+require_user_or_admin = CheckedRoleIs(allowed_roles=["user","admin"])
   
 async def validate_refresh_token(token: Annotated[str, Depends(oauth2_scheme)]):  
-    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")  
     try:  
         #logger.debug(f"this is token {token}")
         #logger.debug(f"this is refresh token {refresh_tokens}")
 
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])  
-        logger.debug(f"payload {payload}")
+        payload = _cached_decode(token, REFRESH_TOKEN_KIND)  
+        logger.debug("payload %s", payload)
         username: str = payload.get("sub")  
         role: str = payload.get("role")  
         if username is None or role is None:  
-            logger.debug(f"user {username} or role {role} is none")
-            raise credentials_exception 
+            logger.debug("user %s or role %s is none", username, role)
+            raise _credentials_exception() 
     except (JWTError, ValidationError):  
-        logger.debug(f"some weird error???")
-        raise credentials_exception  
+        logger.debug("some weird error???")
+        raise _credentials_exception()  
+
+    # consume the token before the first await, so concurrent requests with the same token can't both get past this check
+    if refresh_tokens.pop(hash_token(token, REFRESH_TOKEN_KIND), None) is None:
+        logger.debug("refresh token was not issued by us or has already been used")
+        raise _credentials_exception()
   
-    user = await get_user_by_name_from_MongoDB(username)  
+    user = await _get_user_cached(username)  
   
     if user is None:  
-        raise credentials_exception  
+        raise _credentials_exception()  
   
     return user, token  
\ No newline at end of file
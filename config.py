@@ -1,5 +1,6 @@
 # Read configuration information from config.ini
 import configparser
+from datetime import timedelta
 
 config = configparser.ConfigParser()
 config.read("config.ini")
@@ -9,7 +10,15 @@ SECRET_KEY = config.get(CONFIG_AUTH_SECTION, "SECRET_KEY")
 ALGORITHM = config.get(CONFIG_AUTH_SECTION, "ALGORITHM") 
 ACCESS_TOKEN_EXPIRE_MINUTES = int(config.get(CONFIG_AUTH_SECTION, "ACCESS_TOKEN_EXPIRE_MINUTES"))
 REFRESH_TOKEN_EXPIRE_MINUTES = int(config.get(CONFIG_AUTH_SECTION, "REFRESH_TOKEN_EXPIRE_MINUTES"))
+ACCESS_TOKEN_EXPIRES = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+REFRESH_TOKEN_EXPIRES = timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
 
 MONGODB_SECTION = "MONGODB"
 MONGODB_URL = config.get(MONGODB_SECTION, "MONGODB_URL")
-MONGODB_DATABASE = config.get(MONGODB_SECTION, "MONGODB_DATABASE")
\ No newline at end of file
+MONGODB_DATABASE = config.get(MONGODB_SECTION, "MONGODB_DATABASE")
+MONGODB_MAX_POOL_SIZE = config.getint(MONGODB_SECTION, "MONGODB_MAX_POOL_SIZE", fallback=10)
+MONGODB_MIN_POOL_SIZE = config.getint(MONGODB_SECTION, "MONGODB_MIN_POOL_SIZE", fallback=2)
+MONGODB_MAX_IDLE_TIME_MS = config.getint(MONGODB_SECTION, "MONGODB_MAX_IDLE_TIME_MS", fallback=30000)
+
+LOGGING_SECTION = "LOGGING"
+LOG_LEVEL = config.get(LOGGING_SECTION, "LOG_LEVEL", fallback="INFO").upper()
\ No newline at end of file
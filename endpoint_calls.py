@@ -4,13 +4,14 @@ import logging
 from typing import Annotated
 
 from fastapi import Depends, HTTPException
-from auth import get_current_user
+from auth import get_current_user, invalidate_user
+from config import LOG_LEVEL
 from endpoint import API_Endpoint_Enum
 from models import User
 from mongo_driver import get_permission_by_endpoint_from_MongoDB, get_plan_by_id_MongoDB, update_user_API_usage_in_MongoDB
 
 logger = logging.getLogger('uvicorn.error')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 class UserHasPermission:  
     """
@@ -42,12 +43,14 @@ class UserHasPermission:
         current_plan = await get_plan_by_id_MongoDB(user.subscribed_plan_id)
         current_limit = current_plan.apilimit[perm.id]
 
-        logger.debug(f"Endpoint: {perm.endpoint} Usage: {current_usage}, Remaining: {current_limit - current_usage}")
+        logger.debug("Endpoint: %s Usage: %s, Remaining: %s", perm.endpoint, current_usage, current_limit - current_usage)
 
         if current_usage >= current_limit:
             raise HTTPException(status_code=400, detail=f"User has ran out of API calls for endpoint {perm.endpoint} as per the user's subscribed plan")
 
         # then increment current usage and update the user entry in mongodb
         await update_user_API_usage_in_MongoDB(user, perm)
+        # the cached user now has a stale usage count
+        invalidate_user(user.username)
 
         return True
\ No newline at end of file
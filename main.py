@@ -1,61 +1,90 @@
-from datetime import timedelta
+from contextlib import asynccontextmanager
 import logging
+import time
+import orjson
 from typing import Annotated 
 
-from fastapi import Depends, FastAPI, HTTPException, Body, status
-from fastapi.responses import PlainTextResponse
+from fastapi import Depends, FastAPI, HTTPException, Body, Response, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
   
-from auth import create_token, authenticate_user, CheckedRoleIs, get_current_user, validate_refresh_token, refresh_tokens
+from auth import create_token, authenticate_user, invalidate_user, require_admin, require_user, require_user_or_admin, hash_token, validate_refresh_token, refresh_tokens, REFRESH_TOKEN_KIND
 from endpoint import API_Endpoint_Enum
 from endpoint_calls import UserHasPermission
 from models import APIPermission, APIPlan, UpdateAPIPermission, UpdateAPIPlan, UpdateAPIUsageStats, User, Token  
-from config import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_MINUTES
-from mongo_driver import add_permission_to_MongoDB, add_plan_to_MongoDB, delete_permission_in_MongoDB, delete_plan_in_MongoDB, modify_permission_to_MongoDB, modify_plan_to_MongoDB, subscribe_to_plan_in_MongoDB, update_user_API_plan, view_plan_details_from_user_in_MongoDB, view_usage_statistics_from_user_in_MongoDB
+from config import ACCESS_TOKEN_EXPIRES, LOG_LEVEL, REFRESH_TOKEN_EXPIRES
+from mongo_driver import add_permission_to_MongoDB, add_plan_to_MongoDB, close_MongoDB_client, create_indexes_in_MongoDB, delete_permission_in_MongoDB, delete_plan_in_MongoDB, modify_permission_to_MongoDB, modify_plan_to_MongoDB, subscribe_to_plan_in_MongoDB, update_user_API_plan, view_plan_details_from_user_in_MongoDB, view_usage_statistics_from_user_in_MongoDB
 from bson import ObjectId
 
 # Initialize logger (use the logger instead of print for debugging)
 logger = logging.getLogger('uvicorn.error')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """
+  Make sure the MongoDB indexes exist before serving requests, and release the MongoDB connections on shutdown
+  """
+  await create_indexes_in_MongoDB()
+  yield
+  await close_MongoDB_client()
 
 app = FastAPI(
     title="Cloud Service Access Management System API",
     summary="A backend system for managing access to cloud services based on user subscriptions. \n\
         Role-based access control (RBAC) system where the admin can modify user permissions and subscription plans \n\
             Simulate cloud service usage and enforce limits based on subscription plans",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
-access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)  
-refresh_token_expires = timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)  
+# The demonstration and random endpoints always return the same payload, so encode each one once at import
+# and send the bytes as is (Response objects themselves are not reused across requests)
+PUBLIC_ONLY_BODY = orjson.dumps("This endpoint can be used by everyone")
+USER_ONLY_BODY = orjson.dumps({"data": "This is important data, need to sign in with a user role"})
+ADMIN_ONLY_BODY = orjson.dumps({"data": "This is REALLY important data, need to sign in with an admin role"})
+USER_OR_ADMIN_BODY = orjson.dumps({"data": "This is semi important data, need to sign in with an user or admin role"})
+RANDOM_1_BODY = orjson.dumps("Random 1")
+RANDOM_2_BODY = orjson.dumps("Random 2")
+RANDOM_3_BODY = orjson.dumps("Random 3")
+RANDOM_4_BODY = orjson.dumps("Random 4")
+RANDOM_5_BODY = orjson.dumps("Random 5")
+RANDOM_6_BODY = orjson.dumps("Random 6")
+
+def static_json_response(body: bytes) -> Response:
+  """
+  Wrap an already encoded JSON body in a response without serializing it again
+  """
+  return Response(content=body, media_type="application/json")
 
 # RBAC demonstration endpoints
 @app.get("/publiconly")  
-def public_only():  
+async def public_only():  
   """
   Endpoint that can be accessed by everyone
   """
-  return "This endpoint can be used by everyone"  
+  return static_json_response(PUBLIC_ONLY_BODY)
 
 @app.get("/useronly")  
-def user_only(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"]))]):  
+async def user_only(_: Annotated[User, Depends(require_user)]):  
   """
   Endpoint that can be accessed by users
   """
-  return {"data": "This is important data, need to sign in with a user role"} 
+  return static_json_response(USER_ONLY_BODY)
 
 @app.get("/adminonly")  
-def admin_only(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))]):  
+async def admin_only(_: Annotated[User, Depends(require_admin)]):  
   """
   Endpoint that can be accessed by admin
   """
-  return {"data": "This is REALLY important data, need to sign in with an admin role"}
+  return static_json_response(ADMIN_ONLY_BODY)
 
 @app.get("/useroradmin")  
-def user_or_admin(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user","admin"]))]):  
+async def user_or_admin(_: Annotated[User, Depends(require_user_or_admin)]):  
   """
   Endpoint that can be accessed by users OR admins
   """
-  return {"data": "This is semi important data, need to sign in with an user or admin role"}
+  return static_json_response(USER_OR_ADMIN_BODY)
 
 @app.post("/token",response_description="Login with username and password and get access and refresh tokens")  
 async def login_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:  
@@ -66,12 +95,14 @@ async def login_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Dep
   if not user:  
     raise HTTPException(status_code=400, detail="Incorrect username or password")  
   
-  access_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=access_token_expires)  
-  refresh_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=refresh_token_expires)  
-  refresh_tokens.add(refresh_token)  
-
-  logger.debug(f'did we add access token {access_token}')
-  logger.debug(f'did we add refresh token {refresh_tokens}')
+  access_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=ACCESS_TOKEN_EXPIRES)  
+  refresh_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=REFRESH_TOKEN_EXPIRES)  
+  refresh_tokens[hash_token(refresh_token, REFRESH_TOKEN_KIND)] = time.time()  
+
+  # repr of the refresh token store can be large, so only build these messages when debug logging is on
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug(f'did we add access token {access_token}')
+    logger.debug(f'did we add refresh token {refresh_tokens}')
   return Token(access_token=access_token, refresh_token=refresh_token)  
 
 @app.post("/refresh",response_description="Get new access token when access token expires and when logged in")  
@@ -79,16 +110,12 @@ async def refresh_access_token(token_data: Annotated[tuple[User, str], Depends(v
   """
   Request our refresh token to get a new access token when the access token expires
   """
-  user, token = token_data  
-  access_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=access_token_expires)  
-  refresh_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=refresh_token_expires)  
+  user, _ = token_data  
+  access_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=ACCESS_TOKEN_EXPIRES)  
+  refresh_token = create_token(data={"sub": user.username, "role": user.role}, expires_delta=REFRESH_TOKEN_EXPIRES)  
 
-  try:
-    refresh_tokens.remove(token)  
-  except KeyError:
-    pass
-
-  refresh_tokens.add(refresh_token)  
+  # the old refresh token was already consumed by validate_refresh_token
+  refresh_tokens[hash_token(refresh_token, REFRESH_TOKEN_KIND)] = time.time()  
   return Token(access_token=access_token, refresh_token=refresh_token)
 
 # Permissions endpoints
@@ -96,7 +123,7 @@ async def refresh_access_token(token_data: Annotated[tuple[User, str], Depends(v
 @app.post("/permissions",
           response_description="Add API permission",
           status_code=status.HTTP_201_CREATED)
-async def add_permission(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))], permission : APIPermission = Body(...)):
+async def add_permission(_: Annotated[User, Depends(require_admin)], permission : APIPermission = Body(...)):
   """
   Insert a new API permission
   """
@@ -106,7 +133,7 @@ async def add_permission(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=
 @app.put("/permissions/{permissionId}",
           response_description="Modify API permission",
           status_code=status.HTTP_200_OK)
-async def modify_permission(permissionId : str, _ : Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))] = Body(...), permission : UpdateAPIPermission = Body(...)):
+async def modify_permission(permissionId : str, _ : Annotated[User, Depends(require_admin)] = Body(...), permission : UpdateAPIPermission = Body(...)):
   """
   Update an existing API permission
   """
@@ -116,7 +143,7 @@ async def modify_permission(permissionId : str, _ : Annotated[bool, Depends(Chec
 @app.delete("/permissions/{permissionId}",
           response_description="Delete API permission",
           status_code=status.HTTP_200_OK)
-async def delete_permission(permissionId : str, _ : Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))] = Body(...)):
+async def delete_permission(permissionId : str, _ : Annotated[User, Depends(require_admin)] = Body(...)):
   """
   Update an existing API permission
   """
@@ -128,7 +155,7 @@ async def delete_permission(permissionId : str, _ : Annotated[bool, Depends(Chec
 @app.post("/plans",
           response_description="Add plan",
           status_code=status.HTTP_201_CREATED)
-async def add_plan(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))], plan : APIPlan = Body(...)):
+async def add_plan(_: Annotated[User, Depends(require_admin)], plan : APIPlan = Body(...)):
   """
   Insert a new API permission
   """
@@ -138,7 +165,7 @@ async def add_plan(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admi
 @app.put("/plans/{planId}",
           response_description="Modify plan",
           status_code=status.HTTP_200_OK)
-async def modify_plan(planId : str, _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))], plan : UpdateAPIPlan = Body(...)):
+async def modify_plan(planId : str, _: Annotated[User, Depends(require_admin)], plan : UpdateAPIPlan = Body(...)):
   """
   Insert a new API permission
   """
@@ -148,7 +175,7 @@ async def modify_plan(planId : str, _: Annotated[bool, Depends(CheckedRoleIs(all
 @app.delete("/plans/{planId}",
           response_description="Delete plan",
           status_code=status.HTTP_200_OK)
-async def delete_plan(planId : str, _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))]):
+async def delete_plan(planId : str, _: Annotated[User, Depends(require_admin)]):
   """
   Insert a new API permission
   """
@@ -160,43 +187,46 @@ async def delete_plan(planId : str, _: Annotated[bool, Depends(CheckedRoleIs(all
 @app.post("/subscriptions/",
           response_description="Subscribed to plan (as a user)",
           status_code=status.HTTP_200_OK)
-async def subscribe_plan(planId : str, _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"]))], current_user: Annotated[User, Depends(get_current_user)]):
+async def subscribe_plan(planId : str, current_user: Annotated[User, Depends(require_user)]):
   """
   Subscribe to a plan as a user
   """
   await subscribe_to_plan_in_MongoDB(planId, current_user)
+  invalidate_user(current_user.username)
   return f"User {current_user} subscribed to plan {planId}"
 
 @app.get("/subscriptions/{userId}",
          response_description="View Subscription Details of a user",
          status_code=status.HTTP_200_OK,
          response_class=PlainTextResponse)
-async def view_subscription_details(userId: str,  _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"]))]):
+async def view_subscription_details(userId: str,  current_user: Annotated[User, Depends(require_user)]):
   """
   View the subscription details: the subscribed plan along with the permissions and the number of API calls allowed
   """
-  details = await view_plan_details_from_user_in_MongoDB(userId)
+  details = await view_plan_details_from_user_in_MongoDB(userId, current_user)
   return f"{details}"
 
 @app.get("/subscriptions/{userId}/usage",
          response_description="View Usage Statistics of a user subscribed to a plan",
          status_code=status.HTTP_200_OK,
          response_class=PlainTextResponse)
-async def view_usage_statistics(userId: str,  _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"]))]):
+async def view_usage_statistics(userId: str,  current_user: Annotated[User, Depends(require_user)]):
   """
   View the usage statistics: the subscribed plan along with the permissions and the number of API calls allowed
   """
-  details = await view_usage_statistics_from_user_in_MongoDB(userId)
+  details = await view_usage_statistics_from_user_in_MongoDB(userId, current_user)
   return f"{details}"
 
 @app.put("/subscriptions/{userId}",
          response_description="Assign/Modify User Plan (as an admin)",
          status_code=status.HTTP_200_OK)
-async def update_user_plan(userId: str, _: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["admin"]))], planId: str, newUsage : UpdateAPIUsageStats = Body(...)):
+async def update_user_plan(userId: str, _: Annotated[User, Depends(require_admin)], planId: str, newUsage : UpdateAPIUsageStats = Body(...)):
   """
   Update the user plan as ADMIN: if the new plan is the same (by id) then just update the usage statistics, otherwise subscribe to new plan
   """
   details = await update_user_API_plan(userId, planId, newUsage)
+  # only the user id is known here, so drop every cached user
+  invalidate_user()
   return f"{details}"
 
 # Note:
@@ -215,44 +245,52 @@ async def update_user_plan(userId: str, _: Annotated[bool, Depends(CheckedRoleIs
 
 # Random APIs (these don't do anything other than be monitored for usage)
 
+# Shared usage checks, one per random endpoint (same reasoning as require_user and friends in auth.py)
+require_random1_usage = UserHasPermission("random1")
+require_random2_usage = UserHasPermission("random2")
+require_random3_usage = UserHasPermission("random3")
+require_random4_usage = UserHasPermission("random4")
+require_random5_usage = UserHasPermission("random5")
+require_random6_usage = UserHasPermission("random6")
+
 @app.get("/random1",response_description="GET random endpoint 1")  
-def get_random_1(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random1"))]):  
+async def get_random_1(_: Annotated[bool, Depends(require_user), Depends(require_random1_usage)]):  
   """
   The 1st random API (users only)
   """
-  return "Random 1"
+  return static_json_response(RANDOM_1_BODY)
 
 @app.get("/random2",response_description="GET random endpoint 2")  
-def get_random_2(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random2"))]):  
+async def get_random_2(_: Annotated[bool, Depends(require_user), Depends(require_random2_usage)]):  
   """
   The 2nd random API (users only)
   """
-  return "Random 2"
+  return static_json_response(RANDOM_2_BODY)
 
 @app.get("/random3",response_description="GET random endpoint 3")  
-def get_random_3(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random3"))]):  
+async def get_random_3(_: Annotated[bool, Depends(require_user), Depends(require_random3_usage)]):  
   """
   The 3rd random API (users only)
   """
-  return "Random 3"
+  return static_json_response(RANDOM_3_BODY)
 
 @app.get("/random4",response_description="GET random endpoint 4")  
-def get_random_4(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random4"))]):  
+async def get_random_4(_: Annotated[bool, Depends(require_user), Depends(require_random4_usage)]):  
   """
   The 4th random API (users only)
   """
-  return "Random 4"
+  return static_json_response(RANDOM_4_BODY)
 
 @app.get("/random5",response_description="GET random endpoint 5")  
-def get_random_5(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random5"))]):  
+async def get_random_5(_: Annotated[bool, Depends(require_user), Depends(require_random5_usage)]):  
   """
   The 5th random API (users only)
   """
-  return "Random 5"
+  return static_json_response(RANDOM_5_BODY)
 
 @app.get("/random6",response_description="GET random endpoint 6")  
-def get_random_6(_: Annotated[bool, Depends(CheckedRoleIs(allowed_roles=["user"])), Depends(UserHasPermission("random6"))]):  
+async def get_random_6(_: Annotated[bool, Depends(require_user), Depends(require_random6_usage)]):  
   """
   The 6th random API (users only)
   """
-  return "Random 6"
\ No newline at end of file
+  return static_json_response(RANDOM_6_BODY)
\ No newline at end of file
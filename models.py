@@ -7,6 +7,8 @@ from endpoint import API_Endpoint_Enum
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
 PyObjectId = Annotated[str, BeforeValidator(str)]
+# Dict keys holding ids (e.g. apilimit) are plain `str`: JSON keys are always strings, so the BeforeValidator
+# would only add a Python call per key while pydantic-core validates the rest of the dict natively.
 
 class User(BaseModel): 
   """
@@ -17,7 +19,7 @@ class User(BaseModel):
   role: str = Field(...)
   password: str = Field(...) # This is a simple application, you can go hash this yourself
   subscribed_plan_id: Optional[str] = Field(default=None)
-  current_api_usage : Optional[Dict[PyObjectId, Annotated[int, Field(ge=0)]]] = Field(default=None)
+  current_api_usage : Optional[Dict[str, Annotated[int, Field(ge=0)]]] = Field(default=None)
 
 class Token(BaseModel):
   """
@@ -40,11 +42,11 @@ class UpdateAPIPermission(BaseModel):
 class APIPlan(BaseModel):
   id: Optional[PyObjectId] = Field(alias="_id", default=None)
   name: str = Field(default="RandomAPIPlan1", validate_default=True)
-  apilimit : Dict[PyObjectId, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":10}, validate_default=True)
+  apilimit : Dict[str, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":10}, validate_default=True)
 
 class UpdateAPIPlan(BaseModel):
   name: str = Field(default="RandomAPIPlan1", validate_default=True)
-  apilimit : Dict[PyObjectId, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":10}, validate_default=True)
+  apilimit : Dict[str, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":10}, validate_default=True)
 
 class UpdateAPIUsageStats(BaseModel):
-  current_api_usage : Dict[PyObjectId, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":0}, validate_default=True)
\ No newline at end of file
+  current_api_usage : Dict[str, Annotated[int, Field(gt=0)]] = Field(default={"permissionId":0}, validate_default=True)
\ No newline at end of file
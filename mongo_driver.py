@@ -1,19 +1,28 @@
+import asyncio
 import logging
-from typing import Union
-import motor.motor_asyncio  
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Union
+from cachetools import TTLCache
 from bson import ObjectId
 from bson.errors import InvalidId
-from config import MONGODB_DATABASE, MONGODB_URL
+from config import LOG_LEVEL, MONGODB_DATABASE, MONGODB_MAX_IDLE_TIME_MS, MONGODB_MAX_POOL_SIZE, MONGODB_MIN_POOL_SIZE, MONGODB_URL
 from endpoint import API_Endpoint_Enum
 from models import APIPlan, UpdateAPIPermission, UpdateAPIPlan, UpdateAPIUsageStats, User, APIPermission
 from fastapi import HTTPException, Response, status
-from pymongo import ReturnDocument
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 # Initialize logger (use the logger instead of print for debugging)
 logger = logging.getLogger('uvicorn.error')
-logger.setLevel(logging.DEBUG)
-
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
+logger.setLevel(LOG_LEVEL)
+
+# One client (and so one connection pool) per worker process, shared by every module through the collections below
+client = AsyncMongoClient(
+    MONGODB_URL,
+    maxPoolSize=MONGODB_MAX_POOL_SIZE,
+    minPoolSize=MONGODB_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+)
 db = client.get_database(MONGODB_DATABASE)
 
 USERS_COLLECTION = "users"
@@ -24,22 +33,76 @@ user_collection = db.get_collection(USERS_COLLECTION)
 permissions_collection = db.get_collection(PERMISSIONS_COLLECTION)
 plans_collection = db.get_collection(PLANS_COLLECTION)
 
+# Permissions are read on nearly every protected request but only change through the admin endpoints,
+# so recently read ones are kept in process for a short while; every permission write clears it
+_permission_cache = TTLCache(maxsize=1024, ttl=30)
+# Same for plans (keyed by ObjectId), read on every metered call; modifying or deleting a plan drops it
+_plan_cache = TTLCache(maxsize=256, ttl=60)
+
+async def create_indexes_in_MongoDB():
+    """
+    Create the indexes backing the lookups and dependency checks below (no-op for indexes that already exist)
+    """
+    # the indexes don't depend on each other, so build them concurrently
+    await asyncio.gather(
+        # apilimit keys are permission ids, so a wildcard index is needed for the apilimit.<id> dependency check
+        plans_collection.create_index([("apilimit.$**", 1)]),
+        user_collection.create_index("subscribed_plan_id"),
+        user_collection.create_index("username", unique=True),
+        permissions_collection.create_index("endpoint", unique=True),
+        # not unique: nothing stops two permissions (for different endpoints) from sharing a name
+        permissions_collection.create_index("name"),
+    )
+
+async def close_MongoDB_client():
+    """
+    Close the client's connection pool and monitoring tasks (call on app shutdown)
+    """
+    await client.close()
+
 # Design goal:
 # Essentially if an object B is dependent on object A; then prevent all changes (modify/delete) to object A until the dependency between B and A is removed
 
+def _raise_if_exception(result):
+    """
+    asyncio.gather(..., return_exceptions=True) hands exceptions back as results; re-raise them so concurrent checks still fail in a fixed order
+    """
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def _from_db(cls, doc: dict):
+    """
+    Build a model from a MongoDB document without validating it again (everything in the db was validated before it was written)
+    """
+    # model_construct skips the validators, so do the conversions they would have done
+    doc["_id"] = str(doc["_id"])
+    if "endpoint" in doc:
+        doc["endpoint"] = API_Endpoint_Enum(doc["endpoint"])
+    return cls.model_construct(**doc)
+
 # User methods
 
+@lru_cache(maxsize=4096)
+def _cast_objectid(id: str) -> ObjectId:
+    """
+    Parse an id string into an ObjectId, memoized since the same few ids (the caller, their plan, its permissions) come up on every request
+    """
+    return ObjectId(id)
+
 def trycastobjectId(id) -> Union[ObjectId,None]:
     """
     Exception wrapper that handles casting an id into an ObjectId
     """
-    object_id : Union[ObjectId,None] = None
     try:
-        object_id = ObjectId(id)
-        return object_id
+        # only memoize hex strings: ObjectId(None) generates a fresh id on every call, and ObjectIds/bytes need no parsing cache
+        if not isinstance(id, str):
+            return ObjectId(id)
+        return _cast_objectid(id)
     except InvalidId as e:
-        logger.exception(e)
-        raise HTTPException(status_code=400, detail=str(e)) # makes this pretty looking on SwaggerAPI and gives a descriptive response
+        # a malformed id is a client error, so don't log a full traceback for it
+        logger.debug("Invalid ObjectId %r", id)
+        raise HTTPException(status_code=400, detail=str(e)) from None # makes this pretty looking on SwaggerAPI and gives a descriptive response
 
 async def get_user_by_name_from_MongoDB(username: str) -> Union[User,None]:  
     """
@@ -48,7 +111,7 @@ async def get_user_by_name_from_MongoDB(username: str) -> Union[User,None]:
     results = await user_collection.find_one({"username":username})
     if results is None:
         return
-    return User(**results)
+    return _from_db(User, results)
 
 async def get_user_by_id_from_MongoDB(id: str) -> Union[User,None]:  
     """
@@ -57,7 +120,7 @@ async def get_user_by_id_from_MongoDB(id: str) -> Union[User,None]:
     results = await user_collection.find_one({"_id": trycastobjectId(id)})
     if results is None:
         return
-    return User(**results)
+    return _from_db(User, results)
 
 # Permission methods
 
@@ -65,76 +128,94 @@ async def get_permission_by_endpoint_from_MongoDB(endpoint : API_Endpoint_Enum)
     """
     Given a permission name, fetches APIPermission information from the db and return a APIPermission or None if the permission name doesn't exist
     """
+    key = ("endpoint", endpoint.value)
+    cached_permission = _permission_cache.get(key)
+    if cached_permission is not None:
+        return cached_permission
+
     permission = await permissions_collection.find_one({"endpoint":endpoint.value})
     if permission is None:
         return
-    return APIPermission(**permission)
+    perm = _from_db(APIPermission, permission)
+    _permission_cache[key] = perm
+    return perm
 
 async def add_permission_to_MongoDB(permission: APIPermission):
     """
     Add the APIPermission to MongoDB
     """
-    # check if API already exists
-    existing_API = await get_permission_by_endpoint_from_MongoDB(permission.endpoint)
-    if existing_API:
+    # create the permission, the unique index on endpoint rejects it if the API already exists in a permission
+    permission_dump = permission.model_dump(exclude={"id"})
+    try:
+        await permissions_collection.insert_one(permission_dump)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail=f"Endpoint {permission} already exists in a permission")
-    
-    # otherwise just create the permission
-    permission_dump = permission.model_dump(by_alias=True, exclude=["id"])
-    await permissions_collection.insert_one(permission_dump)
+    _permission_cache.clear()
 
 async def modify_permission_to_MongoDB(id : str, permission: UpdateAPIPermission):
     """
     Modify the APIPermission to MongoDB
     """
+    # cast the id once and reuse it in every query below
+    oid = trycastobjectId(id)
+    id_str = str(oid)
+
+    # fetch the permission together with (at most) one plan using it, so both checks take a single round trip
+    # (the sub-pipeline doesn't reference the permission, so it's a plain apilimit.<id> match served by the wildcard index)
+    pipeline = [
+        {"$match": {"_id": oid}},
+        {"$lookup": {
+            "from": PLANS_COLLECTION,
+            "pipeline": [{"$match": {f"apilimit.{id_str}": {"$exists": True}}}, {"$limit": 1}, {"$project": {"_id": 1}}],
+            "as": "used_by",
+        }},
+        {"$project": {"used_by": 1}},
+    ]
+    cursor = await permissions_collection.aggregate(pipeline)
+    existing_permission = await cursor.to_list(1)
+
     # check if ID already exists
-    existing_permission = await permissions_collection.find_one({"_id":trycastobjectId(id)})
     if not existing_permission:
-        raise HTTPException(status_code=400, detail=f"No permission with object id {existing_permission} exist")
+        raise HTTPException(status_code=400, detail=f"No permission with object id {id} exist")
     
     # check if permission is being used by any existing plan and stop update if it is being used
-    used_by_existing_plan = await plans_collection.find_one({ f"apilimit.{trycastobjectId(id)}": {"$exists": True}})
+    used_by_existing_plan = existing_permission[0]["used_by"]
     if used_by_existing_plan:
-        existing_plan = APIPlan(**used_by_existing_plan)
-        raise HTTPException(status_code=400, detail=f"Permission with object id {existing_permission} exist and is used in plan {existing_plan.id}")
-
-    old_permission = APIPermission(**existing_permission)
-
-    if old_permission.endpoint.value != permission.endpoint.value:
-        # There is a change to the endpoint value
-        # We need to check if the new endpoint isn't being used by some existing permission
-        # Simple check: count the number of permissions with endpoint as the new endpoint and ensure it is 0
-        existing_API = await get_permission_by_endpoint_from_MongoDB(permission.endpoint)
-        if existing_API:
-            raise HTTPException(status_code=400, detail=f"Endpoint {permission} already exists in a permission")
+        raise HTTPException(status_code=400, detail=f"Permission with object id {id} exist and is used in plan {used_by_existing_plan[0]['_id']}")
     
-    permission = {
-        k : v for k, v in permission.model_dump(by_alias=True).items() if v is not None
-    }
+    permission_dump = permission.model_dump(exclude_none=True)
 
-    # ok to update current
-    update_result = await permissions_collection.find_one_and_update(
-        {"_id": trycastobjectId(id)},
-        {"$set": permission},
-        return_document=ReturnDocument.AFTER
-    )
+    # ok to update current, the unique index on endpoint rejects it if the new endpoint is used by some other permission
+    try:
+        update_result = await permissions_collection.find_one_and_update(
+            {"_id": oid},
+            {"$set": permission_dump},
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail=f"Endpoint {permission} already exists in a permission")
 
     if update_result is None:
-        raise HTTPException(status_code=500, detail=f"Unable to update permission with id {id} with new values {permission}")
+        raise HTTPException(status_code=500, detail=f"Unable to update permission with id {id} with new values {permission_dump}")
+    _permission_cache.clear()
 
 async def delete_permission_in_MongoDB(id : str):
     """
     Delete the APIPermission in MongoDB
     """
+    # cast the id once and reuse it in every query below
+    oid = trycastobjectId(id)
+    id_str = str(oid)
+
     # check if permission is being used by any existing plan and stop update if it is being used
-    used_by_existing_plan = await plans_collection.find_one({ f"apilimit.{trycastobjectId(id)}": {"$exists": True}})
+    used_by_existing_plan = await plans_collection.find_one({ f"apilimit.{id_str}": {"$exists": True}}, projection={"_id": 1})
     if used_by_existing_plan:
-        existing_plan = APIPlan(**used_by_existing_plan)
-        raise HTTPException(status_code=400, detail=f"Permission with object id {id} exist and is used in plan {existing_plan.id}")
+        raise HTTPException(status_code=400, detail=f"Permission with object id {id} exist and is used in plan {used_by_existing_plan['_id']}")
 
-    delete_result = await permissions_collection.delete_one({"_id": trycastobjectId(id)})
+    delete_result = await permissions_collection.delete_one({"_id": oid})
 
     if delete_result.deleted_count == 1:
+        _permission_cache.clear()
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     raise HTTPException(status_code=404, detail=f"API Permission {id} not found")
@@ -143,10 +224,38 @@ async def get_permission_from_MongoDB(name: str) -> Union[APIPermission, None]:
     """
     Given a permission name, fetches APIPermission information from the db and return a APIPermission or None if the permission name doesn't exist
     """
+    key = ("name", name)
+    cached_permission = _permission_cache.get(key)
+    if cached_permission is not None:
+        return cached_permission
+
     permission = await permissions_collection.find_one({"name": name})
     if permission is None:
         return
-    return APIPermission(**permission)
+    perm = _from_db(APIPermission, permission)
+    _permission_cache[key] = perm
+    return perm
+
+async def get_permissions_by_ids_from_MongoDB(permission_ids: Iterable[str]) -> Dict[str, APIPermission]:
+    """
+    Given several permission ids, fetches them with a single query and return a dict of id -> APIPermission (ids that don't exist are left out)
+    """
+    ids = [trycastobjectId(permission_id) for permission_id in permission_ids]
+    permissions = {}
+    async for permission in permissions_collection.find({"_id": {"$in": ids}}, projection={"name": 1, "endpoint": 1, "description": 1}):
+        perm = _from_db(APIPermission, permission)
+        permissions[perm.id] = perm
+    return permissions
+
+async def check_permissions_exist_in_MongoDB(permission_ids: Iterable[str]):
+    """
+    Raise an exception unless every permission id exists, checked with a single query
+    """
+    ids = {trycastobjectId(permission_id) for permission_id in permission_ids}
+    found = {permission["_id"] async for permission in permissions_collection.find({"_id": {"$in": list(ids)}}, projection={"_id": 1})}
+    if len(found) != len(ids):
+        missing = sorted(str(permission_id) for permission_id in ids - found)
+        raise HTTPException(status_code=400, detail=f"Permission(s) with object id {', '.join(missing)} don't exist; so cannot be attached to plan")
 
 # Plan methods
 
@@ -161,153 +270,174 @@ async def add_plan_to_MongoDB(plan: APIPlan):
         raise HTTPException(status_code=400, detail=f"Plan {plan} need to have APILimit dict")
 
     # double check API already exists, otherwise raise exception
-    for permission_id in plan.apilimit.keys():
-        permission = await permissions_collection.find_one({"_id":trycastobjectId(permission_id)})
-        if not permission:
-            raise HTTPException(status_code=400, detail=f"Permission with id {permission_id} doesn't exist; so cannot be attached to plan")
+    await check_permissions_exist_in_MongoDB(plan.apilimit.keys())
 
     # otherwise just create the plan
-    plan_dump = plan.model_dump(by_alias=True, exclude=["id"])
+    plan_dump = plan.model_dump(exclude={"id"})
     await plans_collection.insert_one(plan_dump)
 
 async def get_plan_by_id_MongoDB(id: str) -> Union[APIPlan, None]:
-    existing_plan = await plans_collection.find_one({"_id":trycastobjectId(id)})
+    oid = trycastobjectId(id)
+    cached_plan = _plan_cache.get(oid)
+    if cached_plan is not None:
+        return cached_plan
+
+    existing_plan = await plans_collection.find_one({"_id":oid})
     if not existing_plan:
         raise HTTPException(status_code=400, detail=f"No plan with object id {id} exist")
-    return APIPlan(**existing_plan)
+    plan = _from_db(APIPlan, existing_plan)
+    _plan_cache[oid] = plan
+    return plan
 
 async def modify_plan_to_MongoDB(id : str, plan: UpdateAPIPlan):
     """
     Modify the APIPermission to MongoDB
     """
-    # check if ID already exists
-    existing_plan = await get_plan_by_id_MongoDB(id)
-    if not existing_plan:
-        raise HTTPException(status_code=400, detail=f"No plan with object id {existing_plan} exist")
+    # cast the id once and reuse it in every query below
+    oid = trycastobjectId(id)
+
+    # the checks below don't depend on each other, so run their queries concurrently
+    existing_plan, used_by_existing_user, permissions_exist = await asyncio.gather(
+        get_plan_by_id_MongoDB(oid),
+        user_collection.find_one({ f"subscribed_plan_id": f"{id}"}, projection={"_id": 1}),
+        check_permissions_exist_in_MongoDB(plan.apilimit.keys()),
+        return_exceptions=True,
+    )
+
+    # check if ID already exists (get_plan_by_id_MongoDB raises the 400 if it doesn't)
+    _raise_if_exception(existing_plan)
     
     # check if plan is being used by any user, if it is; then stop the update
-    used_by_existing_user = await user_collection.find_one({ f"subscribed_plan_id": f"{id}"})
+    used_by_existing_user = _raise_if_exception(used_by_existing_user)
     if used_by_existing_user:
-        existing_user = User(**used_by_existing_user)
-        raise HTTPException(status_code=400, detail=f"Plan with object id {id} exist and is subscribed to by at least one user (user with id {existing_user.id}...)")
+        raise HTTPException(status_code=400, detail=f"Plan with object id {id} exist and is subscribed to by at least one user (user with id {used_by_existing_user['_id']}...)")
     
     # double check API already exists, otherwise raise exception
-    for permission_id in plan.apilimit.keys():
-        permission = await permissions_collection.find_one({"_id":trycastobjectId(permission_id)})
-        if not permission:
-            raise HTTPException(status_code=400, detail=f"Permission with id {permission_id} doesn't exist; so cannot be attached to plan")
+    _raise_if_exception(permissions_exist)
 
-    plan = {
-        k : v for k, v in plan.model_dump(by_alias=True).items() if v is not None
-    }
+    plan = plan.model_dump(exclude_none=True)
 
     # ok to update current
     update_result = await plans_collection.find_one_and_update(
-        {"_id": trycastobjectId(id)},
+        {"_id": oid},
         {"$set": plan},
         return_document=ReturnDocument.AFTER
     )
 
     if update_result is None:
         raise HTTPException(status_code=500, detail=f"Unable to update plan with id {id} with new values {plan}")
+    _plan_cache.pop(oid, None)
 
 async def delete_plan_in_MongoDB(id : str):
     """
     Delete the APIPlan in MongoDB
     """
     # check if plan is being used by any existing user and stop update if it is being used (TODO: WORK IN PROGRESS)
-    used_by_existing_user = await user_collection.find_one({ f"subscribed_plan_id": f"{id}"})
+    used_by_existing_user = await user_collection.find_one({ f"subscribed_plan_id": f"{id}"}, projection={"_id": 1})
     if used_by_existing_user:
-        existing_user = User(**used_by_existing_user)
-        raise HTTPException(status_code=400, detail=f"Plan with object id {id} exist and is subscribed to by at least one user (user with id {existing_user.id}...)")
+        raise HTTPException(status_code=400, detail=f"Plan with object id {id} exist and is subscribed to by at least one user (user with id {used_by_existing_user['_id']}...)")
     
     # do deletion
-    delete_result = await plans_collection.delete_one({"_id": trycastobjectId(id)})
+    oid = trycastobjectId(id)
+    delete_result = await plans_collection.delete_one({"_id": oid})
     if delete_result.deleted_count == 1:
+        _plan_cache.pop(oid, None)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     raise HTTPException(status_code=404, detail=f"API Permission {id} not found")
 
 # User Subscription Handling
 
+async def get_subscriber_from_MongoDB(user_id : str, current_user : Optional[User] = None) -> User:
+    """
+    Fetch a user that can subscribe to plans (role "user"), raise an exception otherwise.
+    If user_id is the signed in user (current_user), reuse it instead of querying the db again
+    """
+    if current_user is not None and current_user.id == user_id:
+        user = current_user
+    else:
+        user = await get_user_by_id_from_MongoDB(user_id)
+        if not user:
+            raise HTTPException(status_code=400, detail=f"No user with object id {user_id} exist")
+    if user.role != "user":
+        raise HTTPException(status_code=400, detail=f"User with object id {user_id} is an Admin and cannot subscribe to plans!")
+    return user
+
 async def subscribe_to_plan_in_MongoDB(plan_id : str, user : User):
     """
     Subscribe to plan in MongoDB by updating the user
     """
     # check if plan is valid
     existing_plan = await get_plan_by_id_MongoDB(plan_id)
-    if not existing_plan:
-        raise HTTPException(status_code=400, detail=f"No plan with object id {plan_id} exist")
-
-    # check if user is valid
-    user_found_by_id = await get_user_by_id_from_MongoDB(user.id)
-    if not user_found_by_id:
-        raise HTTPException(status_code=400, detail=f"No user with object id {user.id} exist")
     
     user.subscribed_plan_id = plan_id
 
     # set the usage to 0
-    user.current_api_usage = {plan_id:0 for plan_id,_ in existing_plan.apilimit.items()}
-
-    user_id = user.id
-    user = {
-        k : v for k, v in user.model_dump(by_alias=True, exclude=["id"]).items() if v is not None
-    }
+    user.current_api_usage = dict.fromkeys(existing_plan.apilimit, 0)
 
-    # ok to update current
-    update_result = await user_collection.find_one_and_update(
-        {"_id": trycastobjectId(user_id)},
-        {"$set": user},
-        return_document=ReturnDocument.AFTER
+    # ok to update current (only the two fields that changed), the user is checked by the update matching it
+    update_result = await user_collection.update_one(
+        {"_id": trycastobjectId(user.id)},
+        {"$set": {"subscribed_plan_id": user.subscribed_plan_id, "current_api_usage": user.current_api_usage}}
     )
 
-    if update_result is None:
-        raise HTTPException(status_code=500, detail=f"Unable to subscribe user with id {user_id} to plan {plan_id}")
+    if update_result.matched_count == 0:
+        raise HTTPException(status_code=400, detail=f"No user with object id {user.id} exist")
     
-async def view_plan_details_from_user_in_MongoDB(userId : str) -> str:
+async def view_plan_details_from_user_in_MongoDB(userId : str, current_user : Optional[User] = None) -> str:
     """
     View plan details of a user
     """
     # check if user is valid
-    user = await get_user_by_id_from_MongoDB(userId)
-    if not user:
-        raise HTTPException(status_code=400, detail=f"No user with object id {userId} exist")
-    if not user.role == "user":
-        raise HTTPException(status_code=400, detail=f"User with object id {userId} is an Admin and cannot subscribe to plans!")
+    user = await get_subscriber_from_MongoDB(userId, current_user)
 
-    # check if plan is valid
-    existing_plan = await get_plan_by_id_MongoDB(user.subscribed_plan_id) if user.subscribed_plan_id else None
-    if not existing_plan:
+    if not user.subscribed_plan_id:
         raise HTTPException(status_code=400, detail=f"User id {userId} doesn't have a subscribed plan")
-    plan = existing_plan
 
-    output = "User (id: {0}) {1}; role: {2}".format(user.id, user.username, user.role)
-    output += "\nSubscribed to plan (id: {0}) {1}".format(user.subscribed_plan_id, plan.name)
-    output += "\n~~~~ PLAN DETAILS ~~~~"
+    # fetch the plan and join in its permissions server side, so it takes a single round trip
+    # (apilimit keys are permission ids as strings, so they are turned back into ObjectIds to match the permissions' _id)
+    pipeline = [
+        {"$match": {"_id": trycastobjectId(user.subscribed_plan_id)}},
+        {"$addFields": {"permission_ids": {"$map": {"input": {"$objectToArray": "$apilimit"}, "as": "kv", "in": {"$toObjectId": "$$kv.k"}}}}},
+        {"$lookup": {"from": PERMISSIONS_COLLECTION, "localField": "permission_ids", "foreignField": "_id", "as": "permissions"}},
+        {"$project": {"permission_ids": 0}},
+    ]
+    cursor = await plans_collection.aggregate(pipeline)
+    plan_docs = await cursor.to_list(1)
+
+    # check if plan is valid
+    if not plan_docs:
+        raise HTTPException(status_code=400, detail=f"No plan with object id {user.subscribed_plan_id} exist")
+    plan_doc = plan_docs[0]
+    permissions = {str(permission["_id"]): _from_db(APIPermission, permission) for permission in plan_doc.pop("permissions")}
+    plan = _from_db(APIPlan, plan_doc)
+
+    # collect the lines and join them once at the end
+    lines = [
+        f"User (id: {user.id}) {user.username}; role: {user.role}",
+        f"Subscribed to plan (id: {user.subscribed_plan_id}) {plan.name}",
+        "~~~~ PLAN DETAILS ~~~~",
+    ]
 
-    # fetch permission details
     for permission_id, limit in plan.apilimit.items():
-        permission = await permissions_collection.find_one({"_id":trycastobjectId(permission_id)})
-        if not permission:
+        perm = permissions.get(permission_id)
+        if not perm:
             raise HTTPException(status_code=400, detail=f"Permission with id {permission_id} doesn't exist; it should not be in plan {plan.id}")
-        perm = APIPermission(**permission)
-        output += "\n"
-        output += "\nPermission (id: {0}) {1}".format(perm.id,perm.name)
-        output += "\nEndpoint: {0} API call limit: {1}".format(perm.endpoint,limit)
-        output += "\nDescription: {0}".format(perm.description)
+        lines += [
+            "",
+            f"Permission (id: {perm.id}) {perm.name}",
+            f"Endpoint: {perm.endpoint} API call limit: {limit}",
+            f"Description: {perm.description}",
+        ]
     
-    return output
+    return "\n".join(lines)
 
-async def view_usage_statistics_from_user_in_MongoDB(userId : str) -> str:
+async def view_usage_statistics_from_user_in_MongoDB(userId : str, current_user : Optional[User] = None) -> str:
     """
     View usage statistics from a user
     """
     # check if user is valid
-    user = await get_user_by_id_from_MongoDB(userId)
-    if not user:
-        raise HTTPException(status_code=400, detail=f"No user with object id {userId} exist")
-    if not user.role == "user":
-        raise HTTPException(status_code=400, detail=f"User with object id {userId} is an Admin and cannot subscribe to plans!")
+    user = await get_subscriber_from_MongoDB(userId, current_user)
 
     # check if plan is valid
     existing_plan = await get_plan_by_id_MongoDB(user.subscribed_plan_id) if user.subscribed_plan_id else None
@@ -316,64 +446,47 @@ async def view_usage_statistics_from_user_in_MongoDB(userId : str) -> str:
     plan = existing_plan
 
     # fetch statistics details
-    output = "User (id: {0}) {1}; role: {2}".format(user.id, user.username, user.role)
-    output += "\nSubscribed to plan (id: {0}) {1}".format(user.subscribed_plan_id, plan.name)
-    output += "\n~~~~ USAGE DETAILS ~~~~"
+    lines = [
+        f"User (id: {user.id}) {user.username}; role: {user.role}",
+        f"Subscribed to plan (id: {user.subscribed_plan_id}) {plan.name}",
+        "~~~~ USAGE DETAILS ~~~~",
+    ]
 
+    permissions = await get_permissions_by_ids_from_MongoDB(user.current_api_usage.keys())
     for permission_id, usage in user.current_api_usage.items():
-        permission = await permissions_collection.find_one({"_id":trycastobjectId(permission_id)})
-        if not permission:
+        perm = permissions.get(permission_id)
+        if not perm:
             raise HTTPException(status_code=400, detail=f"Permission with id {permission_id} doesn't exist; it should not be in plan {plan.id}")
-        perm = APIPermission(**permission)
-        output += "\n"
-        output += "\nPermission (id: {0}) {1}".format(perm.id,perm.name)
-        output += "\nEndpoint: {0} API usage so far: {1}".format(perm.endpoint, usage)
-        output += "\nDescription: {0}".format(perm.description)
+        lines += [
+            "",
+            f"Permission (id: {perm.id}) {perm.name}",
+            f"Endpoint: {perm.endpoint} API usage so far: {usage}",
+            f"Description: {perm.description}",
+        ]
 
-    return output
+    return "\n".join(lines)
 
 async def update_user_API_usage_in_MongoDB(user : User, permission : APIPermission):
     """
     Update user's API usage in MongoDB
     """
-    # check if user is valid
-    user = await get_user_by_id_from_MongoDB(user.id)
-    if not user:
-        raise HTTPException(status_code=400, detail=f"No user with object id {user.id} exist")
-    if not user.role == "user":
-        raise HTTPException(status_code=400, detail=f"User with object id {user.id} is an Admin and cannot subscribe to plans!")
-    permission_in_mongoDB = await get_permission_by_endpoint_from_MongoDB(permission.endpoint)
-    if not (permission.id in user.current_api_usage) or not (permission_in_mongoDB):
-        raise HTTPException(status_code=400, detail=f"Permission with object id {permission.id} is not a valid permission")
-
-    user.current_api_usage[permission.id] += 1
-
-    # update the user
-    user_id = user.id
-    user = {
-        k : v for k, v in user.model_dump(by_alias=True, exclude=["id"]).items() if v is not None
-    }
-
-    # ok to update current
-    update_result = await user_collection.find_one_and_update(
-        {"_id": trycastobjectId(user_id)},
-        {"$set": user},
-        return_document=ReturnDocument.AFTER
+    # atomically bump just this permission's counter; the filter checks that the user exists, isn't an admin
+    # and has the permission in their plan, so no reads are needed beforehand and concurrent calls can't lose an increment
+    usage_field = f"current_api_usage.{permission.id}"
+    update_result = await user_collection.update_one(
+        {"_id": trycastobjectId(user.id), "role": "user", usage_field: {"$exists": True}},
+        {"$inc": {usage_field: 1}}
     )
 
-    if update_result is None:
-        raise HTTPException(status_code=500, detail=f"Unable to update user's API usage with user id {user_id}, permission id {permission.id}")
+    if update_result.matched_count == 0:
+        raise HTTPException(status_code=400, detail=f"Permission with object id {permission.id} is not a valid permission for user with object id {user.id}")
     
 async def update_user_API_plan(user_id : str, plan_id : str, new_usage_stats : UpdateAPIUsageStats):
     """
     Update user's API usage stats or subscribed plan in MongoDB
     """
     # check if user is valid
-    user = await get_user_by_id_from_MongoDB(user_id)
-    if not user:
-        raise HTTPException(status_code=400, detail=f"No user with object id {user_id} exist")
-    if not user.role == "user":
-        raise HTTPException(status_code=400, detail=f"User with object id {user_id} is an Admin and cannot subscribe to plans!")
+    user = await get_subscriber_from_MongoDB(user_id)
     if not user.subscribed_plan_id:
         raise HTTPException(status_code=400, detail=f"User with object id {user_id} is not subscribed to any plan; unable to update user API plan")
 
@@ -395,20 +508,13 @@ async def update_user_API_plan(user_id : str, plan_id : str, new_usage_stats : U
         # then we override the old set and update the user
         user.current_api_usage = new_usage_stats.current_api_usage
 
-        # update the user
-        user_id = user.id
-        user = {
-            k : v for k, v in user.model_dump(by_alias=True, exclude=["id"]).items() if v is not None
-        }
-
-        # ok to update current
-        update_result = await user_collection.find_one_and_update(
-            {"_id": trycastobjectId(user_id)},
-            {"$set": user},
-            return_document=ReturnDocument.AFTER
+        # ok to update current (only the usage statistics changed)
+        update_result = await user_collection.update_one(
+            {"_id": trycastobjectId(user.id)},
+            {"$set": {"current_api_usage": user.current_api_usage}}
         )
 
-        if update_result is None:
+        if update_result.matched_count == 0:
             raise HTTPException(status_code=500, detail=f"Unable to update user's API usage with user id {user_id}, usage stats {new_usage_stats}")
         
         return f"Update user {user_id}'s usage statistics {new_usage_stats}"